@@ -7,6 +7,7 @@ from datetime import datetime
 import uuid
 import shutil
 import io
+import textwrap
 
 # Set page config
 st.set_page_config(page_title="VLM Dataset Builder", layout="wide")
@@ -29,6 +30,15 @@ if 'current_image_index' not in st.session_state:
     st.session_state.current_image_index = 0
 if 'current_values' not in st.session_state:
     st.session_state.current_values = {}
+# Maps frame_path -> position in dataset so saves don't scan the whole list
+if 'frame_index' not in st.session_state:
+    st.session_state.frame_index = {}
+# Export directory whose index.json has already been resumed from
+if 'index_loaded_dir' not in st.session_state:
+    st.session_state.index_loaded_dir = None
+# Export directory whose index.json is known to match the dataset (None = unknown)
+if 'index_synced_dir' not in st.session_state:
+    st.session_state.index_synced_dir = None
 if 'export_dir' not in st.session_state:
     st.session_state.export_dir = "vlm_dataset_export"
     # Create export directory structure
@@ -53,22 +63,31 @@ def load_images_from_directory(directory="image_raw"):
     return sorted(image_files)
 
 def go_to_next_image():
-    """Navigate to next image"""
+    """Navigate to next image (used as a button callback, so no rerun is needed)"""
     save_current_annotation()
     if st.session_state.image_files:
         st.session_state.current_image_index = (st.session_state.current_image_index + 1) % len(st.session_state.image_files)
         load_current_annotation()
-        # Force rerun to update the interface with new values
-        st.rerun()
 
 def go_to_previous_image():
-    """Navigate to previous image"""
+    """Navigate to previous image (used as a button callback, so no rerun is needed)"""
     save_current_annotation()
     if st.session_state.image_files:
         st.session_state.current_image_index = (st.session_state.current_image_index - 1) % len(st.session_state.image_files)
         load_current_annotation()
-        # Force rerun to update the interface with new values
-        st.rerun()
+
+def save_and_go_to_next_image():
+    """Take the submitted form values, save them and move to the next image"""
+    current_image_path = get_current_image_path()
+    for key in st.session_state.annotation_keys:
+        field_key = get_field_key(key, current_image_path)
+        if field_key in st.session_state:
+            st.session_state.current_values[key] = st.session_state[field_key]
+    go_to_next_image()
+
+def get_field_key(key, image_path):
+    """Widget key for an annotation field, unique per image so typed values don't carry over"""
+    return f"field_{key}_{image_path}"
 
 def get_current_image_path():
     """Get the path of the current image"""
@@ -83,11 +102,7 @@ def save_current_annotation():
         return
     
     # Check if we already have an entry for this image
-    existing_entry_idx = None
-    for idx, entry in enumerate(st.session_state.dataset):
-        if entry.get("frame_path") == current_image_path:
-            existing_entry_idx = idx
-            break
+    existing_entry_idx = st.session_state.frame_index.get(current_image_path)
     
     # Prepare values for save
     values = st.session_state.current_values.copy()
@@ -106,6 +121,7 @@ def save_current_annotation():
         entry_id = str(uuid.uuid4())
         new_entry = {'id': entry_id}
         new_entry.update(values)
+        st.session_state.frame_index[current_image_path] = len(st.session_state.dataset)
         st.session_state.dataset.append(new_entry)
         entry = new_entry
     
@@ -129,25 +145,72 @@ def save_current_annotation():
     with open(json_path, 'w') as f:
         json.dump(json_data, f, indent=2)
     
-    # Update index.json
-    update_index_file()
+    # Update index.json - append new entries while the file matches the dataset
+    if st.session_state.index_synced_dir != st.session_state.export_dir:
+        update_index_file()
+    elif existing_entry_idx is None:
+        append_index_entry(entry)
+
+def get_index_entry(entry):
+    """Build the index.json record for a dataset entry"""
+    original_filename = os.path.basename(entry["frame_path"])
+    base_name = os.path.splitext(original_filename)[0]
+    
+    return {
+        "image": f"images/{original_filename}",
+        "annotation": f"annotations/{base_name}.json"
+    }
 
 def update_index_file():
     """Update the index.json file with current dataset entries"""
     index_data = []
     for entry in st.session_state.dataset:
         if "frame_path" in entry:
-            original_filename = os.path.basename(entry["frame_path"])
-            base_name = os.path.splitext(original_filename)[0]
-            
-            index_entry = {
-                "image": f"images/{original_filename}",
-                "annotation": f"annotations/{base_name}.json"
-            }
-            index_data.append(index_entry)
+            index_data.append(get_index_entry(entry))
     
     with open(os.path.join(st.session_state.export_dir, "index.json"), 'w') as f:
         json.dump(index_data, f, indent=2)
+    
+    st.session_state.index_synced_dir = st.session_state.export_dir
+
+def append_index_entry(entry):
+    """Append a single entry to index.json without rewriting the whole file"""
+    index_path = os.path.join(st.session_state.export_dir, "index.json")
+    if st.session_state.index_synced_dir != st.session_state.export_dir or not os.path.exists(index_path):
+        # The file may have drifted from the dataset, rewrite it
+        update_index_file()
+        return
+    
+    # Same layout json.dump(..., indent=2) produces for a list item
+    newline = os.linesep.encode()
+    item = textwrap.indent(json.dumps(get_index_entry(entry), indent=2), "  ")
+    item = item.replace("\n", os.linesep).encode()
+    
+    with open(index_path, 'rb+') as f:
+        # Find the closing bracket of the array near the end of the file
+        f.seek(0, os.SEEK_END)
+        tail_start = max(0, f.tell() - 64)
+        f.seek(tail_start)
+        tail = f.read().rstrip()
+        appended = tail.endswith(b"]")
+        if appended:
+            body = tail[:-1].rstrip()
+            separator = newline if body.endswith(b"[") else b"," + newline
+            f.seek(tail_start + len(body))
+            f.write(separator + item + newline + b"]")
+            f.truncate()
+    
+    if not appended:
+        # Unexpected layout, fall back to a full rewrite
+        update_index_file()
+
+def rebuild_frame_index():
+    """Rebuild the frame_path -> dataset position lookup"""
+    st.session_state.frame_index = {
+        entry["frame_path"]: idx
+        for idx, entry in enumerate(st.session_state.dataset)
+        if "frame_path" in entry
+    }
 
 def load_current_annotation():
     """Load annotation for current image into the form"""
@@ -160,22 +223,22 @@ def load_current_annotation():
     st.session_state.current_values = {}
     
     # Find if we have an entry for this image
-    for entry in st.session_state.dataset:
-        if entry.get("frame_path") == current_image_path:
-            # Load values
-            st.session_state.current_values = {
-                k: v for k, v in entry.items() 
-                if k not in ["id", "frame_path"]
-            }
-            
-            # Handle arrays for display
-            for key, value in st.session_state.current_values.items():
-                if isinstance(value, list):
-                    st.session_state.current_values[key] = ", ".join(map(str, value))
-            
-            return
+    entry_idx = st.session_state.frame_index.get(current_image_path)
+    if entry_idx is None:
+        # No existing entry found - current_values is already empty
+        return
+    
+    # Load values
+    entry = st.session_state.dataset[entry_idx]
+    st.session_state.current_values = {
+        k: v for k, v in entry.items() 
+        if k not in ["id", "frame_path"]
+    }
     
-    # No existing entry found - current_values is already empty
+    # Handle arrays for display
+    for key, value in st.session_state.current_values.items():
+        if isinstance(value, list):
+            st.session_state.current_values[key] = ", ".join(map(str, value))
 
 def add_entry(values):
     """Add new entry to the dataset with dynamic keys"""
@@ -189,6 +252,8 @@ def add_entry(values):
         elif st.session_state.annotation_keys[key]["required"]:
             return None, f"Missing required field: {key}"
     
+    if "frame_path" in new_entry:
+        st.session_state.frame_index[new_entry["frame_path"]] = len(st.session_state.dataset)
     st.session_state.dataset.append(new_entry)
     return entry_id, None
 
@@ -203,6 +268,7 @@ def delete_entry(idx):
             os.remove(json_path)
     
     del st.session_state.dataset[idx]
+    rebuild_frame_index()
     update_index_file()
 
 def add_key():
@@ -254,13 +320,54 @@ def delete_key(key):
                 
     return None
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_image_thumbnail(image_path, width, mtime):
+    """Decode an image once and return a downscaled copy for display
+    
+    mtime is only part of the cache key so edited files get decoded again.
+    """
+    image = Image.open(image_path)
+    # Keep twice the display width so images stay sharp on high-DPI screens
+    image.thumbnail((width * 2, image.height))
+    buffer = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(buffer, format="PNG")
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def show_image(image_path, width, caption=None):
+    """Display an image through the thumbnail cache"""
+    thumbnail = load_image_thumbnail(image_path, width, os.path.getmtime(image_path))
+    st.image(thumbnail, width=width, caption=caption)
+
+@st.cache_data(show_spinner=False)
+def build_example_json(key_types):
+    """Build the example JSON for a tuple of (key, type) pairs"""
+    example = {}
+    for key, key_type in key_types:
+        if key != "frame_path":
+            if key_type == "string":
+                example[key] = "example text"
+            elif key_type == "float":
+                example[key] = 42.5
+            elif key_type == "integer":
+                example[key] = 42
+            elif key_type == "boolean":
+                example[key] = True
+            elif key_type == "array":
+                example[key] = ["item1", "item2"]
+    
+    return json.dumps(example, indent=2)
+
 # Initialize image_raw directory
 if not os.path.exists("image_raw"):
     os.makedirs("image_raw", exist_ok=True)
 
-# Try to load from index.json
+# Try to load from index.json (once per export directory)
 index_path = os.path.join(st.session_state.export_dir, "index.json")
-if os.path.exists(index_path) and ('dataset' not in st.session_state or not st.session_state.dataset):
+if st.session_state.index_loaded_dir != st.session_state.export_dir and os.path.exists(index_path) and not st.session_state.dataset:
+    st.session_state.index_loaded_dir = st.session_state.export_dir
     try:
         with open(index_path, 'r') as f:
             index_data = json.load(f)
@@ -317,6 +424,11 @@ if os.path.exists(index_path) and ('dataset' not in st.session_state or not st.s
                             "required": False
                         }
         
+        # Appending is only safe if no records were skipped; otherwise the
+        # first save rewrites index.json from the dataset
+        if len(st.session_state.dataset) == len(index_data):
+            st.session_state.index_synced_dir = st.session_state.export_dir
+        
         # Load all images from image_raw
         if not st.session_state.image_files:
             st.session_state.image_files = load_images_from_directory("image_raw")
@@ -324,9 +436,13 @@ if os.path.exists(index_path) and ('dataset' not in st.session_state or not st.s
         st.success(f"Loaded {len(st.session_state.dataset)} annotations from previous session")
     except Exception as e:
         st.error(f"Error loading from index.json: {e}")
+    finally:
+        # Keep the lookup in line with whatever was loaded, even on errors
+        rebuild_frame_index()
 
-# Create sidebar
-with st.sidebar:
+@st.fragment
+def render_sidebar():
+    """Sidebar controls, re-rendered on their own when a sidebar widget changes"""
     st.title("VLM Dataset Builder")
     st.markdown("Build datasets for Vision-Language Model training")
     
@@ -378,13 +494,13 @@ with st.sidebar:
             st.success(f"Key '{st.session_state.new_key_name}' added")
             st.rerun()
     
-    # Dataset summary
-    st.subheader("Dataset Summary")
-    st.write(f"Total entries: {len(st.session_state.dataset)}")
-    
     # Export options
     st.subheader("Export Settings")
-    st.session_state.export_dir = st.text_input("Export Directory", st.session_state.export_dir)
+    export_dir = st.text_input("Export Directory", st.session_state.export_dir)
+    if export_dir != st.session_state.export_dir:
+        st.session_state.export_dir = export_dir
+        # Rerun the whole app so the new directory's index.json gets resumed
+        st.rerun()
     
     # Ensure export directories exist when path changes
     if st.button("Update Export Directory"):
@@ -397,6 +513,7 @@ with st.sidebar:
         confirmation = st.checkbox("Confirm delete all annotations", value=False)
         if confirmation:
             st.session_state.dataset = []
+            st.session_state.frame_index = {}
             # Remove all JSON files
             annotations_dir = os.path.join(st.session_state.export_dir, "annotations")
             if os.path.exists(annotations_dir):
@@ -406,152 +523,165 @@ with st.sidebar:
             # Reset index file
             with open(os.path.join(st.session_state.export_dir, "index.json"), 'w') as f:
                 json.dump([], f, indent=2)
+            st.session_state.index_synced_dir = st.session_state.export_dir
                 
             st.success("Dataset cleared")
     
     # Show example JSON structure
     st.subheader("Example JSON Structure")
-    example = {}
-    for key, properties in st.session_state.annotation_keys.items():
-        if key != "frame_path":
+    key_types = tuple((key, properties["type"]) for key, properties in st.session_state.annotation_keys.items())
+    st.code(build_example_json(key_types), language="json")
+    st.write("For an image 'a.jpg', this will be saved as 'a.json'")
+
+@st.fragment
+def render_annotation_panel():
+    """Image and annotation form, re-rendered on their own when navigating"""
+    # Dataset summary lives here so it stays current after fragment-only saves
+    st.write(f"Total entries: {len(st.session_state.dataset)}")
+    
+    # Check if we have images loaded
+    if not st.session_state.image_files:
+        st.info("No images loaded. Please load images from the sidebar first.")
+        return
+    
+    # Display current image status
+    current_image_path = get_current_image_path()
+    if not current_image_path:
+        return
+    
+    st.write(f"Annotating image {st.session_state.current_image_index + 1} of {len(st.session_state.image_files)}")
+    
+    # Display the current image
+    try:
+        show_image(current_image_path, 400, caption=f"Image: {os.path.basename(current_image_path)}")
+    except Exception as e:
+        st.error(f"Error loading image: {e}")
+    
+    # Navigation buttons
+    col1, col2, col3 = st.columns([1, 3, 1])
+    with col1:
+        st.button("← Previous", on_click=go_to_previous_image, shortcut="Ctrl+Shift+Enter")
+    with col3:
+        st.button("Next →", on_click=go_to_next_image)
+    
+    # Annotation form
+    with st.form(key="annotation_form"):
+        # Create form fields for all keys
+        for key, properties in st.session_state.annotation_keys.items():
+            if key == "frame_path":
+                # This is handled automatically
+                continue
+            
+            required_text = " (Required)" if properties["required"] else ""
+            field_label = f"{key}{required_text}"
+            field_key = get_field_key(key, current_image_path)
+            
+            # Set default value from current_values if it exists
+            default_value = st.session_state.current_values.get(key, None)
+            
             if properties["type"] == "string":
-                example[key] = "example text"
+                st.session_state.current_values[key] = st.text_input(field_label, value=default_value if default_value else "", key=field_key)
             elif properties["type"] == "float":
-                example[key] = 42.5
+                st.session_state.current_values[key] = st.number_input(field_label, value=float(default_value) if default_value is not None else 0.0, step=0.1, format="%.2f", key=field_key)
             elif properties["type"] == "integer":
-                example[key] = 42
+                st.session_state.current_values[key] = st.number_input(field_label, value=int(default_value) if default_value is not None else 0, step=1, key=field_key)
             elif properties["type"] == "boolean":
-                example[key] = True
+                st.session_state.current_values[key] = st.checkbox(field_label, value=bool(default_value) if default_value is not None else False, key=field_key)
             elif properties["type"] == "array":
-                example[key] = ["item1", "item2"]
+                st.session_state.current_values[key] = st.text_input(field_label + " (comma-separated items)", value=default_value if default_value else "", key=field_key)
+        
+        # Submit buttons
+        col1, col2 = st.columns(2)
+        with col1:
+            submit_button = st.form_submit_button("Save Annotation")
+        with col2:
+            st.form_submit_button("Save & Next", type="primary", on_click=save_and_go_to_next_image, shortcut="Ctrl+Enter")
     
-    st.code(json.dumps(example, indent=2), language="json")
-    st.write("For an image 'a.jpg', this will be saved as 'a.json'")
+    # Handle form submission
+    if submit_button:
+        save_current_annotation()
+        st.success("Annotation saved")
+
+@st.fragment
+def render_dataset_preview():
+    """Latest dataset entries, refreshed on demand instead of on every navigation"""
+    st.button("Refresh Preview", help="Entries saved while annotating show up here after a refresh")
+    
+    if len(st.session_state.dataset) > 0:
+        # Only the last 10 entries are shown, newest first
+        newest = st.session_state.dataset[-10:][::-1]
+        for offset, entry in enumerate(newest):
+            idx = len(st.session_state.dataset) - 1 - offset
+            with st.container():
+                cols = st.columns([1, 3, 1])
+                
+                # Display image
+                with cols[0]:
+                    try:
+                        filename = os.path.basename(entry["frame_path"])
+                        show_image(entry["frame_path"], 150)
+                        st.write(f"**Filename:** {filename}")
+                    except Exception as e:
+                        st.error(f"Error loading image: {e}")
+                
+                # Display metadata
+                with cols[1]:
+                    for key, value in entry.items():
+                        if key not in ["id", "frame_path"]:
+                            st.write(f"**{key}:** {value}")
+                
+                # Actions
+                with cols[2]:
+                    if st.button("Delete", key=f"delete_{entry['id']}"):
+                        delete_entry(idx)
+                        st.rerun()
+                
+                # Show JSON preview for this entry
+                json_preview = {}
+                for key, value in entry.items():
+                    if key not in ["id", "frame_path"]:
+                        json_preview[key] = value
+                
+                filename = os.path.basename(entry["frame_path"])
+                base_name = os.path.splitext(filename)[0]
+                st.write(f"**{base_name}.json:**")
+                st.code(json.dumps(json_preview, indent=2), language="json")
+                
+                st.divider()
+    else:
+        st.info("No entries yet. Add some images and corresponding values to build your dataset.")
+    
+    # Directory structure preview
+    if len(st.session_state.dataset) > 0:
+        st.header("Output Directory Structure Preview")
+        
+        structure = [
+            "vlm_dataset_export/",
+            "├── images/",
+            "│   ├── image1.jpg",
+            "│   ├── image2.jpg",
+            "│   └── ...",
+            "├── annotations/",
+            "│   ├── image1.json",
+            "│   ├── image2.json",
+            "│   └── ...",
+            "└── index.json"
+        ]
+        
+        st.code("\n".join(structure), language=None)
+
+# Create sidebar
+with st.sidebar:
+    render_sidebar()
 
 # Main content
 st.title("VLM Dataset Builder")
 
 # Image navigation and annotation
 st.header("Image Annotation")
-
-# Check if we have images loaded
-if not st.session_state.image_files:
-    st.info("No images loaded. Please load images from the sidebar first.")
-else:
-    # Display current image status
-    current_image_path = get_current_image_path()
-    if current_image_path:
-        st.write(f"Annotating image {st.session_state.current_image_index + 1} of {len(st.session_state.image_files)}")
-        
-        # Display the current image
-        try:
-            image = Image.open(current_image_path)
-            st.image(image, width=400, caption=f"Image: {os.path.basename(current_image_path)}")
-        except Exception as e:
-            st.error(f"Error loading image: {e}")
-        
-        # Navigation buttons
-        col1, col2, col3 = st.columns([1, 3, 1])
-        with col1:
-            if st.button("← Previous"):
-                go_to_previous_image()
-        with col3:
-            if st.button("Next →"):
-                go_to_next_image()
-        
-        # Annotation form
-        with st.form(key="annotation_form"):
-            # Create form fields for all keys
-            for key, properties in st.session_state.annotation_keys.items():
-                if key == "frame_path":
-                    # This is handled automatically
-                    continue
-                    
-                required_text = " (Required)" if properties["required"] else ""
-                field_label = f"{key}{required_text}"
-                
-                # Set default value from current_values if it exists
-                default_value = st.session_state.current_values.get(key, None)
-                
-                if properties["type"] == "string":
-                    st.session_state.current_values[key] = st.text_input(field_label, value=default_value if default_value else "")
-                elif properties["type"] == "float":
-                    st.session_state.current_values[key] = st.number_input(field_label, value=float(default_value) if default_value is not None else 0.0, step=0.1, format="%.2f")
-                elif properties["type"] == "integer":
-                    st.session_state.current_values[key] = st.number_input(field_label, value=int(default_value) if default_value is not None else 0, step=1)
-                elif properties["type"] == "boolean":
-                    st.session_state.current_values[key] = st.checkbox(field_label, value=bool(default_value) if default_value is not None else False)
-                elif properties["type"] == "array":
-                    st.session_state.current_values[key] = st.text_input(field_label + " (comma-separated items)", value=default_value if default_value else "")
-            
-            # Submit button
-            submit_button = st.form_submit_button("Save Annotation")
-        
-        # Handle form submission
-        if submit_button:
-            save_current_annotation()
-            st.success("Annotation saved")
+st.caption("Shortcuts: Ctrl+Enter to save and go to the next image, Ctrl+Shift+Enter to go back")
+render_annotation_panel()
 
 # Display dataset
 st.header("Dataset Preview")
-
-if len(st.session_state.dataset) > 0:
-    for idx, entry in enumerate(st.session_state.dataset[::-1][:10]):
-        with st.container():
-            cols = st.columns([1, 3, 1])
-            
-            # Display image
-            with cols[0]:
-                try:
-                    img = Image.open(entry["frame_path"])
-                    filename = os.path.basename(entry["frame_path"])
-                    st.image(img, width=150)
-                    st.write(f"**Filename:** {filename}")
-                except Exception as e:
-                    st.error(f"Error loading image: {e}")
-            
-            # Display metadata
-            with cols[1]:
-                for key, value in entry.items():
-                    if key not in ["id", "frame_path"]:
-                        st.write(f"**{key}:** {value}")
-            
-            # Actions
-            with cols[2]:
-                if st.button("Delete", key=f"delete_{idx}"):
-                    delete_entry(idx)
-                    st.rerun()
-            
-            # Show JSON preview for this entry
-            json_preview = {}
-            for key, value in entry.items():
-                if key not in ["id", "frame_path"]:
-                    json_preview[key] = value
-            
-            filename = os.path.basename(entry["frame_path"])
-            base_name = os.path.splitext(filename)[0]
-            st.write(f"**{base_name}.json:**")
-            st.code(json.dumps(json_preview, indent=2), language="json")
-            
-            st.divider()
-else:
-    st.info("No entries yet. Add some images and corresponding values to build your dataset.")
-
-# Directory structure preview
-if len(st.session_state.dataset) > 0:
-    st.header("Output Directory Structure Preview")
-    
-    structure = [
-        "vlm_dataset_export/",
-        "├── images/",
-        "│   ├── image1.jpg",
-        "│   ├── image2.jpg",
-        "│   └── ...",
-        "├── annotations/",
-        "│   ├── image1.json",
-        "│   ├── image2.json",
-        "│   └── ...",
-        "└── index.json"
-    ]
-    
-    st.code("\n".join(structure), language=None)
\ No newline at end of file
+render_dataset_preview()
\ No newline at end of file